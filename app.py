@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
+import os
+
+# 单样本推理以延迟为主，限制OpenMP为单线程，避免每次预测唤醒线程池（须在加载xgboost之前设置）
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 import streamlit as st
-import joblib
-import shap
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import streamlit.components.v1 as components
-import os
-
-# 配置Matplotlib中文字体（必须放在其他matplotlib操作之前）
-plt.rcParams['font.sans-serif'] = ['SimHei']  # Windows系统黑体
-plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+import gc
+import bisect
+import sys
+import ctypes
 
 # 配置页面
 st.set_page_config(
@@ -19,124 +19,253 @@ st.set_page_config(
     layout="wide"
 )
 
+# 静态页面文本（模块级常量，每次重跑直接复用）
+USAGE_MD = """**使用说明**:  
+输入患者的基线指标，点击"预测"按钮获取6个月内出血风险及个体化建议。  
+模型基于随机森林算法构建，并通过SHAP值解释预测依据。"""
+
+INDICATOR_MD = """
+    - **NLR**: 反映全身炎症状态  
+    - **血小板/脾脏比值**: 门静脉高压严重程度指标  
+    - **门静脉宽度**: 门静脉高压严重程度指标  
+    - **IV型胶原**: 肝纤维化标志物  
+    """
+
+RESULT_CARD_HTML = """
+    <div style="border-left: 5px solid {color}; padding: 10px;">
+        <h4 style="color: {color};">{risk_level}风险</h4>
+        <p>6个月内出血概率: <b>{risk_percent:.2f}%</b></p>
+        <p>临床建议: {advice}</p>
+    </div>
+    """
+
+FOOTER_TEXT = "© 2024 布加综合征研究组。预测工具仅限临床医生使用，不作为诊疗唯一依据。"
+
+# 风险分级表：概率(%)分界点升序排列，RISK_TIERS比分界点多一档，依次为 (风险等级, 临床建议, 颜色)
+RISK_THRESHOLDS = [10.0, 30.0]
+RISK_TIERS = [
+    ("低危", "每3个月常规随访，维持抗凝治疗", "#2E86C1"),
+    ("中危", "每2周门诊随访，启动非选择性β受体阻滞剂治疗", "#FFA500"),
+    ("高危", "立即住院监测，优先安排内镜检查，考虑预防性TIPS", "#FF4B4B"),
+]
+
+# 侧边栏输入控件配置：特征名关键字 -> (标签后缀, number_input参数)
+FIELD_SPECS = {
+    "NLR": ("", dict(min_value=0.1, value=3.5, step=0.1)),
+    "血小板": (" (PC/SD) (×10⁹/L/cm)", dict(min_value=0.1, value=18.0, step=0.1)),
+    "门静脉": (" (PVW) (mm)", dict(min_value=5.0, value=14.0, step=0.1)),
+    "IV型胶原": (" (IV Collagen) (ng/mL)", dict(min_value=0.0, value=200.0, step=1.0)),
+}
+DEFAULT_FIELD_SPEC = ("", dict(min_value=0.0, value=0.0, step=0.1))
+
+# SHAP力图渲染方式：matplotlib（默认，服务端静态PNG）或 js（前端交互力图，需内嵌shap JS包）
+RENDER_MODE = os.environ.get("RENDER_MODE", "matplotlib")
+
 
 @st.cache_resource
 def load_assets():
+    # 重量级依赖延迟到此处导入，配合cache_resource每个进程只导入一次
+    import joblib
+
     base_path = os.path.dirname(__file__)
     model_path = os.path.join(base_path, "assets", "bcs_hemorrhage_xgb_model.pkl")
+    model_ubj_path = os.path.join(base_path, "assets", "bcs_hemorrhage_xgb_model.ubj")
     feature_names_path = os.path.join(base_path, "assets", "feature_names2.pkl")
 
-    model = joblib.load(model_path)
+    # 优先加载XGBoost原生UBJSON格式（加载更快，且无需反序列化pickle），不存在时回退到pickle
+    if os.path.exists(model_ubj_path):
+        import xgboost
+        model = xgboost.XGBClassifier()
+        model.load_model(model_ubj_path)
+    else:
+        model = joblib.load(model_path)
     feature_names = joblib.load(feature_names_path)
-    explainer = shap.TreeExplainer(model)
-    return model, explainer, feature_names
+    booster = model.get_booster()
+    # 输入缓冲区形状固定，加载时校验一次特征数，预测时不再逐次校验
+    if booster.num_features() != len(feature_names):
+        raise ValueError(
+            f"模型特征数({booster.num_features()})与特征名数量({len(feature_names)})不一致"
+        )
+    # 特征名直接记录在booster上，预测与解释均可直接输入ndarray
+    booster.feature_names = list(feature_names)
+    booster.set_param({"nthread": 1})
+    return booster, feature_names
 
 
-model, explainer, feature_names = load_assets()
+booster, feature_names = load_assets()
 
+# 每个会话独立的预分配输入缓冲区，侧边栏输入原地写入，避免重复构造DataFrame
+if "input_buf" not in st.session_state:
+    st.session_state.input_buf = np.empty((1, len(feature_names)), dtype=np.float32)
+input_buf = st.session_state.input_buf
 
-def st_shap(plot, height=500):
-    shap_html = f"<head>{shap.getjs()}</head><body>{plot.html()}</body>"
-    components.html(shap_html, height=height)
+# 生成英文特征名列表（用于SHAP图标注）
+modified_feature_names = []
+for name in feature_names:
+    if "血小板计数/脾脏最大径" in name:
+        modified_feature_names.append("PC/SD")
+    elif "门静脉宽度" in name:
+        modified_feature_names.append("PVW")
+    elif "IV型胶原" in name:
+        modified_feature_names.append("IV Collagen")
+    else:
+        modified_feature_names.append(name.split(' ')[0])
 
 
-st.title("布加综合征上消化道出血风险预测")
-st.markdown("""**使用说明**:  
-输入患者的基线指标，点击"预测"按钮获取6个月内出血风险及个体化建议。  
-模型基于随机森林算法构建，并通过SHAP值解释预测依据。""")
+@st.cache_data(max_entries=512)
+def _shap_cached(key):
+    # 使用XGBoost原生C++ TreeSHAP（pred_contribs）；结果是确定性的，按输入取值缓存
+    import xgboost
 
-with st.sidebar:
-    st.header("患者指标输入")
-    input_values = []
-    for feature in feature_names:
-        if "NLR" in feature:
-            val = st.number_input(f"{feature}", min_value=0.1, value=3.5, step=0.1)
-        elif "血小板" in feature:
-            val = st.number_input(f"{feature} (PC/SD) (×10⁹/L/cm)", min_value=0.1, value=18.0, step=0.1)
-        elif "门静脉" in feature:
-            val = st.number_input(f"{feature} (PVW) (mm)", min_value=5.0, value=14.0, step=0.1)
-        elif "IV型胶原" in feature:
-            val = st.number_input(f"{feature} (IV Collagen) (ng/mL)", min_value=0.0, value=200.0, step=1.0)
-        input_values.append(val)
-    predict_button = st.button("开始预测")
+    x = np.asarray(key, dtype=np.float32).reshape(1, -1)
+    dmat = xgboost.DMatrix(x, feature_names=booster.feature_names, nthread=1)
+    contribs = booster.predict(dmat, pred_contribs=True)[0]
+    # 最后一列为基准值（expected value），其余为各特征SHAP值
+    return float(contribs[-1]), contribs[:-1]
 
-if predict_button:
-    input_df = pd.DataFrame([input_values], columns=feature_names)
 
-    # 预测概率
-    prob = model.predict_proba(input_df)[0][1]
-    risk_percent = round(prob * 100, 2)
+@st.cache_data
+def _gain_importance():
+    # 模型整体特征重要性（增益），直接取自booster，无需逐例SHAP计算
+    import pandas as pd
+
+    gain = booster.get_score(importance_type="gain")
+    return pd.Series(
+        [gain.get(name, 0.0) for name in feature_names], index=modified_feature_names
+    )
+
+
+@st.cache_data
+def _field_specs(names):
+    # 每个特征匹配一次控件配置，后续重跑直接复用
+    return [
+        next((spec for keyword, spec in FIELD_SPECS.items() if keyword in name), DEFAULT_FIELD_SPEC)
+        for name in names
+    ]
+
+
+def _trim_memory():
+    # 回收SHAP计算与绘图产生的临时对象，并把glibc空闲堆页归还系统，抑制长时间运行的内存增长
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+# 力图完全由输入决定，两种渲染结果均按输入缓存，跳过重复绘图
+@st.cache_data(max_entries=64)
+def _force_html(shap_values, base_value, row):
+    import shap
 
-    # 风险分级
-    if risk_percent >= 30:
-        risk_level = "高危"
-        advice = "立即住院监测，优先安排内镜检查，考虑预防性TIPS"
-        color = "#FF4B4B"
-    elif risk_percent >= 10:
-        risk_level = "中危"
-        advice = "每2周门诊随访，启动非选择性β受体阻滞剂治疗"
-        color = "#FFA500"
+    plot = shap.force_plot(
+        base_value=base_value,
+        shap_values=shap_values,
+        features=row,
+        feature_names=modified_feature_names
+    )
+    plot_html = plot.html()
+    _trim_memory()
+    return plot_html
+
+
+@st.cache_data(max_entries=64)
+def _force_png(shap_values, base_value, row):
+    import io
+    import matplotlib
+    matplotlib.use("Agg")  # 服务端只需离屏渲染，固定使用Agg画布
+    import matplotlib.pyplot as plt
+    import shap
+
+    # 配置Matplotlib中文字体
+    plt.rcParams['font.sans-serif'] = ['SimHei']  # Windows系统黑体
+    plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+
+    fig = shap.force_plot(
+        base_value=base_value,
+        shap_values=shap_values,
+        features=row,
+        feature_names=modified_feature_names,
+        matplotlib=True,
+        show=False
+    )
+    png = io.BytesIO()
+    fig.savefig(png, format="png", dpi=90, bbox_inches="tight")
+    plt.close(fig)
+    _trim_memory()
+    return png.getvalue()
+
+
+@st.cache_resource
+def _shap_head():
+    # shap前端JS包体积较大，连同<head>包装每个进程只拼接一次
+    import shap
+
+    return f"<head>{shap.getjs()}</head>"
+
+
+def st_shap(plot_html, height=500):
+    shap_html = f"{_shap_head()}<body>{plot_html}</body>"
+    components.html(shap_html, height=height)
+
+
+def render_explanation(shap_values, base_value, row):
+    if RENDER_MODE == "js":
+        st_shap(_force_html(shap_values, base_value, row), height=300)
     else:
-        risk_level = "低危"
-        advice = "每3个月常规随访，维持抗凝治疗"
-        color = "#2E86C1"
-        
-if predict_button:
-    input_df = pd.DataFrame([input_values], columns=feature_names)
-    
+        st.image(_force_png(shap_values, base_value, row))
+
+
+# 结果区作为独立片段：片段内的交互（如切换SHAP详情）只重跑本函数，不重跑整页
+@st.fragment
+def render_prediction(prob, key):
+    risk_percent = round(prob * 100, 2)
+
+    # 风险分级（落在分界点上归入较高一档）
+    risk_level, advice, color = RISK_TIERS[bisect.bisect_right(RISK_THRESHOLDS, risk_percent)]
+
     # 显示预测结果
     st.subheader("预测结果")
-    st.markdown(f"""
-    <div style="border-left: 5px solid {color}; padding: 10px;">
-        <h4 style="color: {color};">{risk_level}风险</h4>
-        <p>6个月内出血概率: <b>{risk_percent:.2f}%</b></p>
-        <p>临床建议: {advice}</p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(
+        RESULT_CARD_HTML.format(color=color, risk_level=risk_level, risk_percent=risk_percent, advice=advice),
+        unsafe_allow_html=True
+    )
 
-   # SHAP解释部分移动到此处
     st.subheader("预测解释")
-    with st.spinner("生成SHAP解释..."):
-        # 生成英文特征名列表
-        modified_feature_names = []
-        for name in feature_names:
-            if "血小板计数/脾脏最大径" in name:
-                modified_feature_names.append("PC/SD")
-            elif "门静脉宽度" in name:
-                modified_feature_names.append("PVW")
-            elif "IV型胶原" in name:
-                modified_feature_names.append("IV Collagen")
-            else:
-                modified_feature_names.append(name.split(' ')[0])
-
-        # 计算SHAP值
-        shap_values = explainer.shap_values(input_df)
-
-        # 创建新的图形对象
-        plt.figure()
-        force_plot = shap.force_plot(
-            base_value=explainer.expected_value,
-            shap_values=shap_values[0],
-            features=input_df.iloc[0, :],
-            feature_names=modified_feature_names,
-            matplotlib=True,
-            show=False
-        )
-
-        # 显示图形并明确传递对象
-        st.pyplot(force_plot)
-        plt.close()
+    show_shap_detail = st.checkbox("显示详细SHAP解释")
+    if (risk_level == "低危" or prob > 0.99) and not show_shap_detail:
+        # 低危（随访建议固定）或概率接近1时力图信息量有限，改为展示特征增益重要性，跳过SHAP计算
+        st.caption("低危或预测概率接近1，以下为模型整体特征重要性（增益）；勾选“显示详细SHAP解释”可查看个体化解释。")
+        st.bar_chart(_gain_importance())
+    else:
+        with st.spinner("生成SHAP解释..."):
+            # 计算SHAP值并绘图（相同输入命中缓存）
+            base_value, row_shap = _shap_cached(key)
+            render_explanation(row_shap, base_value, np.asarray(key, dtype=np.float32))
 
     # 指标说明
     st.markdown("---")
     st.subheader("指标临床意义")
-    st.markdown("""
-    - **NLR**: 反映全身炎症状态  
-    - **血小板/脾脏比值**: 门静脉高压严重程度指标  
-    - **门静脉宽度**: 门静脉高压严重程度指标  
-    - **IV型胶原**: 肝纤维化标志物  
-    """)
+    st.markdown(INDICATOR_MD)
+
+
+st.title("布加综合征上消化道出血风险预测")
+st.markdown(USAGE_MD)
+
+# 输入放在表单中，仅在提交时重跑脚本，避免每次修改数值都触发整页重跑
+with st.sidebar.form("inp", clear_on_submit=False):
+    st.header("患者指标输入")
+    # 输入值直接写入预分配的float32缓冲区
+    for i, (feature, (suffix, kwargs)) in enumerate(zip(feature_names, _field_specs(tuple(feature_names)))):
+        input_buf[0, i] = st.number_input(f"{feature}{suffix}", **kwargs)
+    predict_button = st.form_submit_button("开始预测")
+
+if predict_button:
+    # 预测概率（binary:logistic 模型的 inplace_predict 直接返回阳性类概率）
+    prob = float(booster.inplace_predict(input_buf, validate_features=False)[0])
+    render_prediction(prob, tuple(round(float(v), 4) for v in input_buf[0]))
 
 # 页脚（保持在外部）
 st.markdown("---")
-st.caption("© 2024 布加综合征研究组。预测工具仅限临床医生使用，不作为诊疗唯一依据。")
+st.caption(FOOTER_TEXT)